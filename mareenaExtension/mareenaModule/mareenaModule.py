@@ -5,6 +5,11 @@ from slicer.ScriptedLoadableModule import *
 import logging
 import numpy
 import math
+import hashlib
+import collections
+import contextlib
+from vtk.util import numpy_support
+from mareenaModuleLib.trackerBus import TrackerBusPublisher, TrackerBusReader
 
 
 #
@@ -66,6 +71,18 @@ class mareenaModuleWidget(ScriptedLoadableModuleWidget):
         self.opticalSelector.setMRMLScene(slicer.mrmlScene)
         parametersFormLayout.addRow("Optical tool tip transform: ",self.opticalSelector)
 
+        self.modelSelector = slicer.qMRMLNodeComboBox()
+        self.modelSelector.nodeTypes = ['vtkMRMLModelNode']
+        self.modelSelector.noneEnabled = True
+        self.modelSelector.setMRMLScene(slicer.mrmlScene)
+        self.modelSelector.setToolTip("Surface to measure the tool tip distances to.")
+        parametersFormLayout.addRow("Surface model: ",self.modelSelector)
+
+        self.publishCheckBox = qt.QCheckBox()
+        self.publishCheckBox.checked = 0
+        self.publishCheckBox.setToolTip("If checked, tool poses and distances are published to the 'mareenaModule' shared memory tracker bus for other processes.")
+        parametersFormLayout.addRow("Publish to tracker bus", self.publishCheckBox)
+
 
         #
         # Apply Button
@@ -80,20 +97,31 @@ class mareenaModuleWidget(ScriptedLoadableModuleWidget):
 
         self.emSelector.connect("currentNodeCHanged(vtkMRMLNode*)", self.onSelect)
         self.opticalSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
+        self.publishCheckBox.connect("toggled(bool)", self.onPublishToggled)
+        self.modelSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onModelSelected)
 
 
         # Add vertical spacer
         self.layout.addStretch(1)
 
+        # Closest point queries against the selected surface model
+        self.tipToModelDistance = TipToModelDistance()
+        self.trackerBusPublisher = None
+
         # Refresh Apply button state
         self.onSelect()
+        self.onModelSelected()
 
     def cleanup(self):
-        pass
+        self.closeTrackerBusPublisher()
 
     def onSelect(self):
         self.applyButton.enabled = self.emSelector.currentNode() and self.opticalSelector.currentNode()
 
+    def onModelSelected(self):
+        # Building the index of a large mesh takes a while, so do it now and not on the next tracker update
+        self.tipToModelDistance.setModel(self.modelSelector.currentNode())
+
     def onApplyButton(self):
         emTipTransform = self.emSelector.currentNode()
         if emTipTransform == None:
@@ -106,6 +134,24 @@ class mareenaModuleWidget(ScriptedLoadableModuleWidget):
 
         opTipTransform.AddObserver(slicer.vtkMRMLTransformNode.TransformModifiedEvent, self.onTransformedModified)
 
+    def onPublishToggled(self, checked):
+        if checked and self.trackerBusPublisher is None:
+            try:
+                self.trackerBusPublisher = TrackerBusPublisher('mareenaModule', ['EmTip', 'OpTip'],
+                                                               ['TipToTip', 'EmTipToSurface', 'OpTipToSurface'])
+            except (RuntimeError, IOError, OSError) as e:
+                slicer.util.errorDisplay('Cannot publish to the tracker bus: ' + str(e))
+                self.publishCheckBox.checked = False
+        elif not checked:
+            self.closeTrackerBusPublisher()
+
+    def closeTrackerBusPublisher(self):
+        # Drop the reference first, so that a failing close() never leaves a half-closed publisher in use
+        publisher = self.trackerBusPublisher
+        self.trackerBusPublisher = None
+        if publisher is not None:
+            publisher.close()
+
     def onTransformedModified(self, caller, event):
         print 'transforms modified'
         emTipTransform = self.emSelector.currentNode()
@@ -129,6 +175,180 @@ class mareenaModuleWidget(ScriptedLoadableModuleWidget):
         distance = numpy.linalg.norm(emTip_Ras - opTip_Ras)
         print distance
 
+        surfaceDistances = [float('nan'), float('nan')]
+        if self.tipToModelDistance.modelNode != None:
+            surfaceDistances = [self.tipToModelDistance.query(tip_Ras[:3])[1] for tip_Ras in [emTip_Ras, opTip_Ras]]
+            logging.debug('Tip to surface distances: EM %s, optical %s' % tuple(surfaceDistances))
+
+        if self.trackerBusPublisher is not None:
+            self.trackerBusPublisher.publish([emTipToRasMatrix, opTipTORasMatrix], [distance] + surfaceDistances)
+
+#
+# TipToModelDistance
+#
+
+class TipToModelDistance(object):
+    """Closest point and signed distance from a point to the surface of a model node.
+    The spatial index over the surface is built once and rebuilt only when the
+    model mesh changes, so queries are cheap enough to run for every tracker update.
+    The distance is negative inside closed surfaces.
+    """
+
+    def __init__(self):
+        self.modelNode = None
+        self._polyData = None
+        self._indexTime = 0
+        self._implicitDistance = vtk.vtkImplicitPolyDataDistance()
+
+    def setModel(self, modelNode):
+        """Selects the model (or None) and builds its index right away
+        """
+        if modelNode is not self.modelNode:
+            self.modelNode = modelNode
+            self._polyData = None
+        self._updateIndex()
+
+    def query(self, point_Ras):
+        """Returns the closest surface point in RAS and the signed distance to it,
+        or (None, NaN) if the model has no surface
+        """
+        if not self._updateIndex():
+            return None, float('nan')
+
+        # The index is built in model coordinates, so move the point there instead of moving the mesh
+        modelToRas = vtk.vtkMatrix4x4()
+        parentTransform = self.modelNode.GetParentTransformNode()
+        if parentTransform is not None:
+            parentTransform.GetMatrixTransformToWorld(modelToRas)
+        rasToModel = vtk.vtkMatrix4x4()
+        vtk.vtkMatrix4x4.Invert(modelToRas, rasToModel)
+
+        point_Model = rasToModel.MultiplyPoint([point_Ras[0], point_Ras[1], point_Ras[2], 1])[:3]
+        closestPoint_Model = [0.0, 0.0, 0.0]
+        signedDistance = self._implicitDistance.EvaluateFunctionAndGetClosestPoint(point_Model, closestPoint_Model)
+        closestPoint_Ras = numpy.array(modelToRas.MultiplyPoint(list(closestPoint_Model) + [1])[:3])
+
+        return closestPoint_Ras, signedDistance
+
+    def _updateIndex(self):
+        """Rebuilds the index if the mesh changed. Returns False if there is no surface to query.
+        """
+        polyData = self.modelNode.GetPolyData() if self.modelNode is not None else None
+        if polyData is None or polyData.GetNumberOfCells() == 0:
+            self._polyData = None
+            return False
+        if polyData is self._polyData and polyData.GetMTime() <= self._indexTime:
+            return True
+        # SetInput triangulates the mesh, computes normals for the sign and builds a cell locator
+        self._implicitDistance.SetInput(polyData)
+        self._polyData = polyData
+        self._indexTime = polyData.GetMTime()
+        return True
+
+#
+# NodeNameCache
+#
+
+class NodeNameCache(object):
+    """Map from node names to nodes of a scene, so that repeated lookups do not search the scene.
+    It follows node additions and removals through scene events; renamed nodes are detected
+    on lookup.
+    """
+
+    def __init__(self, scene):
+        self.scene = scene
+        self._nodes = {}
+        self._observerTags = [
+            scene.AddObserver(slicer.vtkMRMLScene.NodeAddedEvent, self._onNodeAdded),
+            scene.AddObserver(slicer.vtkMRMLScene.NodeRemovedEvent, self._onNodeRemoved),
+            scene.AddObserver(slicer.vtkMRMLScene.EndCloseEvent, self._onSceneClosed)]
+
+    def getNode(self, name):
+        """Returns the first node with the given name, or None
+        """
+        node = self._nodes.get(name)
+        if node is not None and node.GetName() == name and node.GetScene() is self.scene:
+            return node
+        node = self.scene.GetFirstNodeByName(name)
+        if node is None:
+            self._nodes.pop(name, None)
+        else:
+            self._nodes[name] = node
+        return node
+
+    def removeObservers(self):
+        for tag in self._observerTags:
+            self.scene.RemoveObserver(tag)
+        self._observerTags = []
+        self._nodes.clear()
+
+    @vtk.calldata_type(vtk.VTK_OBJECT)
+    def _onNodeAdded(self, caller, event, node):
+        name = node.GetName()
+        if name is not None and name not in self._nodes:
+            self._nodes[name] = node
+
+    @vtk.calldata_type(vtk.VTK_OBJECT)
+    def _onNodeRemoved(self, caller, event, node):
+        name = node.GetName()
+        if self._nodes.get(name) is node:
+            del self._nodes[name]
+
+    def _onSceneClosed(self, caller, event):
+        self._nodes.clear()
+
+#
+# ResultCache
+#
+
+class ResultCache(object):
+    """Bounded LRU cache for logic results, keyed by the content of the input points.
+    Since keys hash the coordinates, points read again from a modified markups node
+    never match a stale entry; old entries are dropped by the LRU eviction.
+    """
+
+    def __init__(self, maxSize=64):
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+
+    def pointsDigest(self, points):
+        """Returns a hash of the coordinates stored in a vtkPoints object
+        """
+        if points.GetNumberOfPoints() == 0:
+            return 'empty'
+        array = numpy.ascontiguousarray(numpy_support.vtk_to_numpy(points.GetData()), dtype=numpy.float64)
+        return hashlib.sha1(array).hexdigest()
+
+    def matrixDigest(self, matrix):
+        elements = [matrix.GetElement(i, j) for i in range(4) for j in range(4)]
+        return hashlib.sha1(numpy.array(elements, dtype=numpy.float64)).hexdigest()
+
+    def get(self, key):
+        if key in self._entries:
+            value = self._entries.pop(key)
+            self._entries[key] = value
+            self.hits = self.hits + 1
+            return value
+        self.misses = self.misses + 1
+        return None
+
+    def put(self, key, value):
+        if key in self._entries:
+            self._entries.pop(key)
+        self._entries[key] = value
+        while len(self._entries) > self.maxSize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def statistics(self):
+        return {'size': len(self._entries), 'maxSize': self.maxSize, 'hits': self.hits, 'misses': self.misses}
+
 #
 # mareenaModuleLogic
 #
@@ -143,39 +363,230 @@ class mareenaModuleLogic(ScriptedLoadableModuleLogic):
     https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
     """
 
-    def averageTransformedDistance(self, pointsA, pointsB, aToBMatrix):
-        average = 0.0
-        numSoFar = 0
-        numPts = pointsA.GetNumberOfPoints()
+    # Shared by all logic instances so that repeated Apply clicks and test runs reuse results
+    resultCache = ResultCache(maxSize=64)
+    nodeNameCache = None
 
-        for i in range(numPts):
-            numSoFar = numSoFar + 1
+    def getNodeByName(self, name):
+        """Returns the first node in the scene with the given name, or None, using a shared cache
+        """
+        if mareenaModuleLogic.nodeNameCache is None or mareenaModuleLogic.nodeNameCache.scene is not slicer.mrmlScene:
+            mareenaModuleLogic.nodeNameCache = NodeNameCache(slicer.mrmlScene)
+        return mareenaModuleLogic.nodeNameCache.getNode(name)
 
-            a = pointsA.GetPoint(i)
-            pointA_Ref = numpy.array(a)
-            pointA_Ref = numpy.append(pointA_Ref, 1)
-            pointA_Ras = aToBMatrix.MultiplyFloatPoint(pointA_Ref)
+    @contextlib.contextmanager
+    def sceneBatch(self):
+        """Context in which scene changes are processed and rendered once, on exit:
 
-            b = pointsB.GetPoint(i)
-            pointB_Ras = numpy.array(b)
-            pointB_Ras = numpy.append(pointB_Ras, 1)
+            with logic.sceneBatch():
+                ... add, remove and modify nodes ...
 
-            distance = numpy.linalg.norm(pointA_Ras - pointB_Ras)
-            average = average + (distance - average) / numSoFar
+        Contexts can be nested. Node modifications should still be wrapped in
+        StartModify/EndModify so that each node fires a single ModifiedEvent.
+        """
+        # pauseRender is only available in recent Slicer versions
+        pauseRender = hasattr(slicer.app, 'pauseRender')
+        slicer.mrmlScene.StartState(slicer.vtkMRMLScene.BatchProcessState)
+        try:
+            if pauseRender:
+                slicer.app.pauseRender()
+            try:
+                yield
+            finally:
+                if pauseRender:
+                    slicer.app.resumeRender()
+        finally:
+            slicer.mrmlScene.EndState(slicer.vtkMRMLScene.BatchProcessState)
+
+    def getOrCreateFiducials(self, name):
+        fiducials = self.getNodeByName(name)
+        if fiducials == None:
+            fiducials = slicer.vtkMRMLMarkupsFiducialNode()
+            fiducials.SetName(name)
+            slicer.mrmlScene.AddNode(fiducials)
+        if fiducials.GetDisplayNode() == None:
+            fiducials.CreateDefaultDisplayNodes()
+        return fiducials
+
+    def averageTransformedDistance(self, pointsA, pointsB, aToBMatrix, useCache=True):
+        """Returns the mean distance between pointsA mapped by aToBMatrix and pointsB.
+        Results are cached by point content.
+        """
+        if useCache:
+            cache = self.resultCache
+            key = ('averageTransformedDistance', cache.pointsDigest(pointsA), cache.pointsDigest(pointsB),
+                   cache.matrixDigest(aToBMatrix))
+            average = cache.get(key)
+            if average is not None:
+                return average
 
+        numPts = pointsA.GetNumberOfPoints()
+        if numPts == 0:
+            average = 0.0
+        else:
+            pointsA_Ref = numpy_support.vtk_to_numpy(pointsA.GetData()).astype(numpy.float64)
+            pointsB_Ras = numpy_support.vtk_to_numpy(pointsB.GetData()).astype(numpy.float64)[:numPts]
+            aToB = numpy.array([[aToBMatrix.GetElement(i, j) for j in range(4)] for i in range(4)])
+            pointsA_Ras = pointsA_Ref.dot(aToB[:3, :3].T) + aToB[:3, 3]
+            average = float(numpy.mean(numpy.linalg.norm(pointsA_Ras - pointsB_Ras, axis=1)))
+
+        if useCache:
+            cache.put(key, average)
         return average
 
-    def rigidRegistration(self, alphaPoints, betaPoints, alphatToBetaMatrix):
+    def rigidRegistration(self, alphaPoints, betaPoints, alphatToBetaMatrix, mode='RigidBody', useCache=True):
+        """Computes the landmark registration from alphaPoints to betaPoints into alphatToBetaMatrix.
+        Mode is one of 'RigidBody', 'Similarity' or 'Affine'.
+        """
+        if useCache:
+            cache = self.resultCache
+            key = ('rigidRegistration', mode, cache.pointsDigest(alphaPoints), cache.pointsDigest(betaPoints))
+            elements = cache.get(key)
+            if elements is not None:
+                alphatToBetaMatrix.DeepCopy(elements)
+                return
 
         # Create transform node for registration
         landmarkTransform = vtk.vtkLandmarkTransform()
         landmarkTransform.SetSourceLandmarks(alphaPoints)
         landmarkTransform.SetTargetLandmarks(betaPoints)
-        landmarkTransform.SetModeToRigidBody()
+        if mode == 'Similarity':
+            landmarkTransform.SetModeToSimilarity()
+        elif mode == 'Affine':
+            landmarkTransform.SetModeToAffine()
+        else:
+            landmarkTransform.SetModeToRigidBody()
         landmarkTransform.Update()
 
         landmarkTransform.GetMatrix(alphatToBetaMatrix)
 
+        if useCache:
+            elements = tuple(alphatToBetaMatrix.GetElement(i, j) for i in range(4) for j in range(4))
+            cache.put(key, elements)
+
+    def weightedRigidRegistration(self, alphaPoints, betaPoints, alphaToBetaMatrix=None, weights=None,
+                                  covariances=None, targets=None, maxIterations=20, tolerance=1e-10):
+        """Rigid registration of alphaPoints to betaPoints with per-point noise.
+        weights are inverse variances of isotropic fiducial errors, covariances are full 3x3
+        fiducial error covariances (anisotropic noise, solved iteratively with Gauss-Newton).
+        Without either, all points are weighted equally with unit variance.
+        Points are vtkPoints or numpy arrays of shape (N, 3), or (B, N, 3) for a batch of
+        B independent point sets solved at once.
+        Returns a dictionary with the 4x4 'matrix' (B, 4, 4 for batches), the RMS 'fre', and
+        the first order 'predictedFRE' and 'predictedTRE' (RMS, at targets given in alpha coordinates).
+        If alphaToBetaMatrix is given and the input is not batched, the result is also copied into it.
+        """
+        alpha = self._pointsArray(alphaPoints)
+        beta = self._pointsArray(betaPoints)
+        batched = alpha.ndim == 3
+        if not batched:
+            alpha = alpha[numpy.newaxis]
+            beta = beta[numpy.newaxis]
+        batchSize, numPts = alpha.shape[:2]
+
+        # Inverse covariance of each fiducial error
+        if covariances is not None:
+            covariances = numpy.broadcast_to(numpy.asarray(covariances, dtype=numpy.float64), (batchSize, numPts, 3, 3))
+            information = numpy.linalg.inv(covariances)
+            weights = 3.0 / numpy.trace(covariances, axis1=2, axis2=3)
+        else:
+            if weights is None:
+                weights = numpy.ones(numPts)
+            weights = numpy.broadcast_to(numpy.asarray(weights, dtype=numpy.float64), (batchSize, numPts))
+            covariances = numpy.eye(3) / weights[..., numpy.newaxis, numpy.newaxis]
+            information = numpy.eye(3) * weights[..., numpy.newaxis, numpy.newaxis]
+
+        # Closed form weighted solution (exact for isotropic noise, starting point otherwise)
+        totalWeight = weights.sum(axis=1)[:, numpy.newaxis]
+        alphaCentroid = numpy.einsum('bn,bni->bi', weights, alpha) / totalWeight
+        betaCentroid = numpy.einsum('bn,bni->bi', weights, beta) / totalWeight
+        crossCovariance = numpy.einsum('bn,bni,bnj->bij', weights, alpha - alphaCentroid[:, numpy.newaxis],
+                                       beta - betaCentroid[:, numpy.newaxis])
+        u, s, vt = numpy.linalg.svd(crossCovariance)
+        reflection = numpy.sign(numpy.linalg.det(numpy.einsum('bji,bkj->bik', vt, u)))
+        u[:, :, 2] = u[:, :, 2] * reflection[:, numpy.newaxis]
+        rotation = numpy.einsum('bji,bkj->bik', vt, u)
+        translation = betaCentroid - numpy.einsum('bij,bj->bi', rotation, alphaCentroid)
+
+        anisotropic = not numpy.allclose(information, information[..., 0:1, 0:1] * numpy.eye(3))
+        for iteration in range(maxIterations if anisotropic else 0):
+            # Gauss-Newton step on a small rotation about the origin and a translation
+            transformed = numpy.einsum('bij,bnj->bni', rotation, alpha) + translation[:, numpy.newaxis]
+            residuals = transformed - beta
+            jacobians = self._pointJacobians(transformed)
+            hessian = numpy.einsum('bnki,bnkl,bnlj->bij', jacobians, information, jacobians)
+            gradient = numpy.einsum('bnki,bnkl,bnl->bi', jacobians, information, residuals)
+            step = -numpy.linalg.solve(hessian, gradient[..., numpy.newaxis])[..., 0]
+            stepRotation = self._rotationMatrices(step[:, :3])
+            rotation = numpy.einsum('bij,bjk->bik', stepRotation, rotation)
+            translation = numpy.einsum('bij,bj->bi', stepRotation, translation) + step[:, 3:]
+            if numpy.max(numpy.abs(step)) < tolerance:
+                break
+
+        matrices = numpy.zeros((batchSize, 4, 4))
+        matrices[:, :3, :3] = rotation
+        matrices[:, :3, 3] = translation
+        matrices[:, 3, 3] = 1.0
+
+        # First order error prediction (Danilchenko and Fitzpatrick): the parameter covariance
+        # is the inverse of the Gauss-Newton hessian when the weights match the noise
+        transformed = numpy.einsum('bij,bnj->bni', rotation, alpha) + translation[:, numpy.newaxis]
+        fre = numpy.sqrt(numpy.mean(numpy.sum((transformed - beta) ** 2, axis=2), axis=1))
+        jacobians = self._pointJacobians(transformed)
+        parameterCovariance = numpy.linalg.inv(numpy.einsum('bnki,bnkl,bnlj->bij', jacobians, information, jacobians))
+        fiducialPrediction = numpy.trace(covariances, axis1=2, axis2=3) \
+            - numpy.einsum('bnij,bjk,bnik->bn', jacobians, parameterCovariance, jacobians)
+        predictedFRE = numpy.sqrt(numpy.mean(fiducialPrediction, axis=1))
+
+        result = {'matrix': matrices, 'fre': fre, 'predictedFRE': predictedFRE}
+        if targets is not None:
+            targets = self._pointsArray(targets)
+            if targets.ndim == 2:
+                targets = numpy.broadcast_to(targets, (batchSize,) + targets.shape)
+            transformedTargets = numpy.einsum('bij,bnj->bni', rotation, targets) + translation[:, numpy.newaxis]
+            targetJacobians = self._pointJacobians(transformedTargets)
+            result['predictedTRE'] = numpy.sqrt(numpy.einsum('bnij,bjk,bnik->bn', targetJacobians,
+                                                             parameterCovariance, targetJacobians))
+
+        if not batched:
+            result = dict((key, value[0]) for key, value in result.items())
+            if alphaToBetaMatrix is not None:
+                alphaToBetaMatrix.DeepCopy(result['matrix'].ravel().tolist())
+        return result
+
+    def _pointsArray(self, points):
+        if hasattr(points, 'GetData'):
+            return numpy_support.vtk_to_numpy(points.GetData()).astype(numpy.float64)
+        return numpy.asarray(points, dtype=numpy.float64)
+
+    def _pointJacobians(self, points):
+        """Derivative of each point with respect to (small rotation vector, translation)
+        """
+        jacobians = numpy.zeros(points.shape[:-1] + (3, 6))
+        x, y, z = points[..., 0], points[..., 1], points[..., 2]
+        # -[p]x
+        jacobians[..., 0, 1] = z
+        jacobians[..., 0, 2] = -y
+        jacobians[..., 1, 0] = -z
+        jacobians[..., 1, 2] = x
+        jacobians[..., 2, 0] = y
+        jacobians[..., 2, 1] = -x
+        jacobians[..., 0, 3] = jacobians[..., 1, 4] = jacobians[..., 2, 5] = 1.0
+        return jacobians
+
+    def _rotationMatrices(self, rotationVectors):
+        """Rodrigues formula for a stack of rotation vectors
+        """
+        angles = numpy.linalg.norm(rotationVectors, axis=1)
+        axes = rotationVectors / numpy.maximum(angles, 1e-300)[:, numpy.newaxis]
+        cross = numpy.zeros((len(angles), 3, 3))
+        cross[:, 0, 1], cross[:, 0, 2] = -axes[:, 2], axes[:, 1]
+        cross[:, 1, 0], cross[:, 1, 2] = axes[:, 2], -axes[:, 0]
+        cross[:, 2, 0], cross[:, 2, 1] = -axes[:, 1], axes[:, 0]
+        sin = numpy.sin(angles)[:, numpy.newaxis, numpy.newaxis]
+        cos = numpy.cos(angles)[:, numpy.newaxis, numpy.newaxis]
+        return numpy.eye(3) + sin * cross + (1 - cos) * numpy.einsum('bij,bjk->bik', cross, cross)
+
     def hasImageData(self, volumeNode):
         """This is an example logic method that
         returns true if the passed in volume
@@ -266,40 +677,85 @@ class mareenaModuleLogic(ScriptedLoadableModuleLogic):
 
         return True
 
-    def generatePoints(self, numPoints, Scale, Sigma):
-
-        rasFids = slicer.util.getNode('RasPoints')
-
-        if rasFids == None:
-            rasFids = slicer.vtkMRMLMarkupsFiducialNode()
-            rasFids.SetName('RasPoints')
-            slicer.mrmlScene.AddNode(rasFids)
-
-        rasFids.RemoveAllMarkups()
-        refFids = slicer.util.getNode('ReferencePoints')
-
-        if refFids == None:
-            refFids = slicer.vtkMRMLMarkupsFiducialNode()
-            refFids.SetName('ReferencePoints')
-            slicer.mrmlScene.AddNode(refFids)
-
-        refFids.RemoveAllMarkups()
-        refFids.GetDisplayNode().SetSelectedColor(1, 1, 0)
+    def thresholdSweep(self, inputVolume, thresholds, maskThresholds=None, slicesPerChunk=16):
+        """Computes, in one pass over the input volume, the number and volume (mm^3) of
+        voxels strictly above each threshold, i.e. the voxels that run() with the same
+        ThresholdValue would replace. Optionally returns the boolean masks for the
+        thresholds listed in maskThresholds.
+        """
+        if not self.hasImageData(inputVolume):
+            slicer.util.errorDisplay('Input volume has no image data.')
+            return None
+
+        thresholds = numpy.asarray(thresholds, dtype=numpy.float64)
+        order = numpy.argsort(thresholds)
+        sortedThresholds = thresholds[order]
+        maskThresholds = list(maskThresholds) if maskThresholds is not None else []
+
+        voxels = slicer.util.arrayFromVolume(inputVolume)
+        masks = dict((t, numpy.zeros(voxels.shape, dtype=bool)) for t in maskThresholds)
+
+        # Histogram of voxels over the intervals between consecutive thresholds:
+        # bin k holds the voxels that are above exactly k of the sorted thresholds.
+        # Slabs bound the memory used by the bin indices.
+        histogram = numpy.zeros(len(sortedThresholds) + 1, dtype=numpy.int64)
+        for start in range(0, voxels.shape[0], slicesPerChunk):
+            slab = voxels[start:start + slicesPerChunk]
+            values = slab.ravel()
+            if values.dtype.kind == 'f':
+                # NaN is not above any threshold (run() keeps it), but searchsorted sorts it last
+                values = values[~numpy.isnan(values)]
+            bins = numpy.searchsorted(sortedThresholds, values, side='left')
+            histogram += numpy.bincount(bins, minlength=len(histogram))
+            for t in maskThresholds:
+                masks[t][start:start + slicesPerChunk] = slab > t
+
+        # Voxels above sortedThresholds[k] are those in bins k+1 and higher
+        aboveSorted = numpy.cumsum(histogram[::-1])[::-1][1:]
+        voxelCounts = numpy.empty_like(aboveSorted)
+        voxelCounts[order] = aboveSorted
+
+        spacing = inputVolume.GetSpacing()
+        voxelVolume = spacing[0] * spacing[1] * spacing[2]
+
+        return {'thresholds': thresholds,
+                'voxelCounts': voxelCounts,
+                'volumes': voxelCounts * voxelVolume,
+                'masks': masks}
+
+    def generatePoints(self, numPoints, Scale, Sigma, rasName='RasPoints', refName='ReferencePoints'):
 
         # Creating two fiducial lists
         fromNormCoord = numpy.random.rand(numPoints, 3)
         noise = numpy.random.normal(0.0, Sigma, numPoints * 3)
 
-        for i in range(numPoints):
-            x = (fromNormCoord[i, 0] - 0.5) * Scale
-            y = (fromNormCoord[i, 1] - 0.5) * Scale
-            z = (fromNormCoord[i, 2] - 0.5) * Scale
-
-            rasFids.AddFiducial(x, y, z)
-            xx = x + noise[i * 3]
-            yy = y + noise[i * 3 + 1]
-            zz = z + noise[i * 3 + 2]
-            refFids.AddFiducial(xx, yy, zz)
+        with self.sceneBatch():
+            rasFids = self.getOrCreateFiducials(rasName)
+            refFids = self.getOrCreateFiducials(refName)
+            refFids.GetDisplayNode().SetSelectedColor(1, 1, 0)
+
+            # Each list fires a single modified event instead of one per added point
+            rasWasModifying = rasFids.StartModify()
+            try:
+                refWasModifying = refFids.StartModify()
+                try:
+                    rasFids.RemoveAllMarkups()
+                    refFids.RemoveAllMarkups()
+
+                    for i in range(numPoints):
+                        x = (fromNormCoord[i, 0] - 0.5) * Scale
+                        y = (fromNormCoord[i, 1] - 0.5) * Scale
+                        z = (fromNormCoord[i, 2] - 0.5) * Scale
+
+                        rasFids.AddFiducial(x, y, z)
+                        xx = x + noise[i * 3]
+                        yy = y + noise[i * 3 + 1]
+                        zz = z + noise[i * 3 + 2]
+                        refFids.AddFiducial(xx, yy, zz)
+                finally:
+                    refFids.EndModify(refWasModifying)
+            finally:
+                rasFids.EndModify(rasWasModifying)
 
     def fiducialsToPoints(self, fiducials, points):
         n = fiducials.GetNumberOfFiducials()
@@ -309,6 +765,79 @@ class mareenaModuleLogic(ScriptedLoadableModuleLogic):
             fiducials.GetNthFiducialPosition(i, p)
             points.InsertNextPoint(p[0], p[1], p[2])
 
+    def simulateTRE(self, numPoints, Scale, Sigma):
+        """Registers numPoints random fiducials to a noisy copy of themselves,
+        as generatePoints does, and returns the TRE at the origin
+        """
+        ras = (numpy.random.rand(numPoints, 3) - 0.5) * Scale
+        ref = ras + numpy.random.normal(0.0, Sigma, (numPoints, 3))
+
+        rasPoints = vtk.vtkPoints()
+        rasPoints.SetData(numpy_support.numpy_to_vtk(ras, deep=True))
+        refPoints = vtk.vtkPoints()
+        refPoints.SetData(numpy_support.numpy_to_vtk(ref, deep=True))
+
+        refToRasMatrix = vtk.vtkMatrix4x4()
+        self.rigidRegistration(refPoints, rasPoints, refToRasMatrix, useCache=False)
+
+        targetPoint_Ras = numpy.array([0, 0, 0, 1])
+        targetPoint_Ref = numpy.array(refToRasMatrix.MultiplyFloatPoint(targetPoint_Ras))
+        return numpy.linalg.norm(targetPoint_Ras - targetPoint_Ref)
+
+    def adaptiveTRESweep(self, nValues, sigmas, tolerance, Scale=100.0, minTrials=10, maxTrials=1000,
+                         maxRefinements=10):
+        """Estimates the mean TRE for each (number of points, sigma) cell, adding trials to a cell
+        only until the width of its 95% confidence interval is below tolerance.
+        After the initial nValues have converged, extra numbers of points are inserted next to
+        the point where the TRE curve bends the most, until the curve is linear within tolerance
+        between samples or maxRefinements is reached.
+        This is a generator: a result dictionary is yielded as soon as each cell converges.
+        """
+        if minTrials < 2:
+            raise ValueError('adaptiveTRESweep needs minTrials >= 2 to estimate a confidence interval')
+
+        for sigma in sigmas:
+            means = {}
+            toSample = sorted(set(nValues))
+            refinements = 0
+            while toSample:
+                for numPoints in toSample:
+                    result = self._estimateTRECell(numPoints, sigma, Scale, tolerance, minTrials, maxTrials)
+                    means[numPoints] = result['meanTRE']
+                    yield result
+
+                toSample = []
+                if refinements >= maxRefinements:
+                    break
+                refinements = refinements + 1
+
+                # Bend: distance of each sample from the line through its neighbours. Refine around the
+                # worst bend that can still be refined (adjacent numbers of points have no midpoint).
+                sampled = sorted(means)
+                bestBend = tolerance
+                for i in range(1, len(sampled) - 1):
+                    n0, n1, n2 = sampled[i - 1], sampled[i], sampled[i + 1]
+                    interpolated = means[n0] + (means[n2] - means[n0]) * float(n1 - n0) / (n2 - n0)
+                    bend = abs(means[n1] - interpolated)
+                    midpoints = [n for n in [(n0 + n1) // 2, (n1 + n2) // 2] if n not in means]
+                    if bend > bestBend and midpoints:
+                        bestBend = bend
+                        toSample = midpoints
+
+    def _estimateTRECell(self, numPoints, sigma, Scale, tolerance, minTrials, maxTrials):
+        values = [self.simulateTRE(numPoints, Scale, sigma) for i in range(minTrials)]
+        while True:
+            halfWidth = 1.96 * numpy.std(values, ddof=1) / math.sqrt(len(values))
+            if 2 * halfWidth < tolerance or len(values) >= maxTrials:
+                break
+            # Estimate how many trials are still needed instead of adding them one by one
+            needed = int(math.ceil(len(values) * (2 * halfWidth / tolerance) ** 2)) - len(values)
+            needed = max(1, min(needed, maxTrials - len(values)))
+            values.extend(self.simulateTRE(numPoints, Scale, sigma) for i in range(needed))
+
+        return {'numberOfPoints': numPoints, 'sigma': sigma, 'trials': len(values),
+                'meanTRE': float(numpy.mean(values)), 'confidenceHalfWidth': halfWidth}
+
 class mareenaModuleTest(ScriptedLoadableModuleTest):
     """
     This is the test case for your scripted module.
@@ -326,40 +855,23 @@ class mareenaModuleTest(ScriptedLoadableModuleTest):
         """
         self.setUp()
         self.test_mareenaModule1()
+        self.setUp()
+        self.test_resultCache()
+        self.setUp()
+        self.test_weightedRegistration()
+        self.setUp()
+        self.test_nodeNameCache()
+        self.setUp()
+        self.test_thresholdSweep()
+        self.setUp()
+        self.test_batchThreshold()
+        self.setUp()
+        self.test_tipToModelDistance()
+        self.setUp()
+        self.test_trackerBus()
 
     def generatePoints(self, numPoints, Scale, Sigma):
-
-        rasFids = slicer.util.getNode('RasPoints')
-
-        if rasFids == None:
-            rasFids = slicer.vtkMRMLMarkupsFiducialNode()
-            rasFids.SetName('RasPoints')
-            slicer.mrmlScene.AddNode(rasFids)
-
-        rasFids.RemoveAllMarkups()
-        refFids = slicer.util.getNode('RefPoints')
-
-        if refFids == None:
-            refFids = slicer.vtkMRMLMarkupsFiducialNode()
-            refFids.SetName('RefPoints')
-            slicer.mrmlScene.AddNode(refFids)
-
-        refFids.RemoveAllMarkups()
-        refFids.GetDisplayNode().SetSelectedColor(1, 1, 0)
-
-        fromNormCoord = numpy.random.rand(numPoints, 3)
-        noise = numpy.random.normal(0.0, Sigma, numPoints * 3)
-
-        for i in range(numPoints):
-            x = (fromNormCoord[i, 0] - 0.5) * Scale
-            y = (fromNormCoord[i, 1] - 0.5) * Scale
-            z = (fromNormCoord[i, 2] - 0.5) * Scale
-
-            rasFids.AddFiducial(x, y, z)
-            xx = x + noise[i * 3]
-            yy = y + noise[i * 3 + 1]
-            zz = z + noise[i * 3 + 2]
-            refFids.AddFiducial(xx, yy, zz)
+        mareenaModuleLogic().generatePoints(numPoints, Scale, Sigma, refName='RefPoints')
 
     def fiducialsToPoints(self, fiducials, points):
         n = fiducials.GetNumberOfFiducials()
@@ -372,7 +884,7 @@ class mareenaModuleTest(ScriptedLoadableModuleTest):
 
     def createChart(self, nVals, TREVals):
 
-        numSamples = 10
+        numSamples = len(nVals)
 
         # Switch to layout 24 that contains a chart view to initiate
         # construction of the widget and chart view node
@@ -439,47 +951,314 @@ class mareenaModuleTest(ScriptedLoadableModuleTest):
 
         logic = mareenaModuleLogic()
 
-        TREVals = []
-        nVals = range(10,70,5)
+        # Show one registration in the scene
+        numPts = 40
+        sigma = 3.0
+        scale = 100.0
 
-        for i in range(10):
+        self.generatePoints(numPts, scale, sigma)
+        rasFids = logic.getNodeByName('RasPoints')
+        refFids = logic.getNodeByName('RefPoints')
 
-            numPts = 10 + i * 5
-            sigma = 3.0
-            scale = 100.0
+        self.fiducialsToPoints(rasFids, rasPoints)
+        self.fiducialsToPoints(refFids, refPoints)
 
-            nVals.append(numPts)
+        refToRasMatrix = vtk.vtkMatrix4x4()
+        logic.rigidRegistration(refPoints, rasPoints, refToRasMatrix)
 
-            self.generatePoints(numPts, scale, sigma)
-            rasFids = slicer.util.getNode('RasPoints')
-            refFids = slicer.util.getNode('RefPoints')
+        det = refToRasMatrix.Determinant()
+        if det < 1e-8:
+            logging.error('All points in one line')
+        else:
+            refToRas.SetMatrixTransformToParent(refToRasMatrix)
+            avgDistance = logic.averageTransformedDistance(refPoints, rasPoints, refToRasMatrix)
+            print "Average distance: " + str(avgDistance)
 
-            self.fiducialsToPoints(rasFids, rasPoints)
-            self.fiducialsToPoints(refFids, refPoints)
+        # TRE sweep: trials are added to each number of points only until the estimate is tight,
+        # and extra numbers of points are sampled where the curve bends
+        tolerance = 0.2
+        maxTrials = 1000
+        TREByN = {}
+        for result in logic.adaptiveTRESweep([10, 20, 40, 80], [sigma], tolerance=tolerance, Scale=scale,
+                                             maxTrials=maxTrials):
+            # Each cell stops once its confidence interval is tight enough or the trial budget is used up,
+            # and refinement only samples numbers of points that were not sampled yet
+            self.assertTrue(2 * result['confidenceHalfWidth'] < tolerance or result['trials'] == maxTrials)
+            self.assertNotIn(result['numberOfPoints'], TREByN)
+            TREByN[result['numberOfPoints']] = result['meanTRE']
+            print "N: %d  TRE: %.3f +/- %.3f (%d trials)" % (result['numberOfPoints'], result['meanTRE'],
+                                                            result['confidenceHalfWidth'], result['trials'])
+
+        nVals = sorted(TREByN)
+        TREVals = [TREByN[n] for n in nVals]
 
-            refToRasMatrix = vtk.vtkMatrix4x4()
-            logic.rigidRegistration(refPoints, rasPoints, refToRasMatrix)
+        # Creating a chart
 
-            det = refToRasMatrix.Determinant()
-            if det < 1e-8:
-                logging.error('All points in one line')
-                continue
+        self.createChart(nVals, TREVals)
 
-            refToRas.SetMatrixTransformToParent(refToRasMatrix)
-            avgDistance = logic.averageTransformedDistance(refPoints, rasPoints, refToRasMatrix)
+    def test_resultCache(self):
 
-            print "Average distance: " + str(avgDistance)
+        logic = mareenaModuleLogic()
+        logic.resultCache.clear()
+
+        self.generatePoints(20, 100.0, 3.0)
+        rasFids = logic.getNodeByName('RasPoints')
+        refFids = logic.getNodeByName('RefPoints')
+
+        rasPoints = vtk.vtkPoints()
+        refPoints = vtk.vtkPoints()
+        self.fiducialsToPoints(rasFids, rasPoints)
+        self.fiducialsToPoints(refFids, refPoints)
+
+        firstMatrix = vtk.vtkMatrix4x4()
+        logic.rigidRegistration(refPoints, rasPoints, firstMatrix)
+        secondMatrix = vtk.vtkMatrix4x4()
+        logic.rigidRegistration(refPoints, rasPoints, secondMatrix)
+
+        stats = logic.resultCache.statistics()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 1)
+        for i in range(4):
+            for j in range(4):
+                self.assertEqual(firstMatrix.GetElement(i, j), secondMatrix.GetElement(i, j))
+
+        # Moving a fiducial changes the points, so the cached result is not reused
+        refFids.SetNthFiducialPosition(0, 0, 0, 0)
+        refPoints.Reset()
+        self.fiducialsToPoints(refFids, refPoints)
+        logic.rigidRegistration(refPoints, rasPoints, secondMatrix)
+        self.assertEqual(logic.resultCache.statistics()['misses'], 2)
+
+    def test_weightedRegistration(self):
 
-            targetPoint_Ras = numpy.array([0, 0, 0, 1])
-            targetPoint_Ref = refToRasMatrix.MultiplyFloatPoint(targetPoint_Ras)
-            targetPoint_Ref = numpy.array(targetPoint_Ref)
+        logic = mareenaModuleLogic()
 
-            TRE = numpy.linalg.norm(targetPoint_Ras - targetPoint_Ref)
+        self.generatePoints(20, 100.0, 3.0)
+        rasPoints = vtk.vtkPoints()
+        refPoints = vtk.vtkPoints()
+        self.fiducialsToPoints(logic.getNodeByName('RasPoints'), rasPoints)
+        self.fiducialsToPoints(logic.getNodeByName('RefPoints'), refPoints)
+
+        # Equal weights give the same result as vtkLandmarkTransform
+        refToRasMatrix = vtk.vtkMatrix4x4()
+        logic.rigidRegistration(refPoints, rasPoints, refToRasMatrix, useCache=False)
+        weightedMatrix = vtk.vtkMatrix4x4()
+        result = logic.weightedRigidRegistration(refPoints, rasPoints, weightedMatrix, weights=numpy.ones(20))
+        for i in range(4):
+            for j in range(4):
+                self.assertAlmostEqual(refToRasMatrix.GetElement(i, j), weightedMatrix.GetElement(i, j), places=4)
+
+        # A batch of anisotropic problems recovers the exact transform from noise-free points
+        ras = numpy.random.rand(5, 20, 3) * 100.0
+        ref = ras + numpy.array([1.0, 2.0, 3.0])
+        covariances = numpy.diag([1.0, 1.0, 9.0])
+        result = logic.weightedRigidRegistration(ref, ras, covariances=covariances, targets=[[0, 0, 0]])
+        self.assertEqual(result['matrix'].shape, (5, 4, 4))
+        self.assertTrue(numpy.allclose(result['matrix'][:, :3, 3], [-1.0, -2.0, -3.0]))
+        self.assertTrue(numpy.all(result['predictedTRE'] > 0))
+
+    def test_nodeNameCache(self):
 
-            TREVals.append(TRE)
+        logic = mareenaModuleLogic()
 
-            print "TRE: " + str(TRE)
+        with logic.sceneBatch():
+            fids = logic.getOrCreateFiducials('CachedPoints')
+        self.assertIs(logic.getNodeByName('CachedPoints'), fids)
 
-        # Creating a chart
+        fids.SetName('RenamedPoints')
+        self.assertIsNone(logic.getNodeByName('CachedPoints'))
+        self.assertIs(logic.getNodeByName('RenamedPoints'), fids)
+
+        slicer.mrmlScene.RemoveNode(fids)
+        self.assertIsNone(logic.getNodeByName('RenamedPoints'))
+
+    def test_thresholdSweep(self):
+
+        logic = mareenaModuleLogic()
+
+        voxels = numpy.random.normal(0.0, 50.0, (20, 30, 40)).astype(numpy.float32)
+        voxels[0, 0, :5] = numpy.nan
+        volumeNode = slicer.vtkMRMLScalarVolumeNode()
+        slicer.mrmlScene.AddNode(volumeNode)
+        volumeNode.SetSpacing(0.5, 0.5, 2.0)
+        slicer.util.updateVolumeFromArray(volumeNode, voxels)
+
+        thresholds = [40.0, -100.0, 0.0, 10.5, 200.0]
+        result = logic.thresholdSweep(volumeNode, thresholds, maskThresholds=[10.5], slicesPerChunk=7)
+
+        for i, t in enumerate(thresholds):
+            self.assertEqual(result['voxelCounts'][i], (voxels > t).sum())
+            self.assertAlmostEqual(result['volumes'][i], (voxels > t).sum() * 0.5)
+        self.assertTrue(numpy.array_equal(result['masks'][10.5], voxels > 10.5))
+
+    def test_batchThreshold(self):
+
+        import shutil
+        import tempfile
+        import SimpleITK as sitk
+        from mareenaModuleLib import batchThreshold
+
+        directory = tempfile.mkdtemp()
+        try:
+            voxels = {}
+            for name in ['a', 'b']:
+                voxels[name] = numpy.random.normal(0.0, 50.0, (4, 5, 6)).astype(numpy.float32)
+                sitk.WriteImage(sitk.GetImageFromArray(voxels[name]), os.path.join(directory, name + '.nrrd'))
+            brokenPath = os.path.join(directory, 'broken.nrrd')
+            with open(brokenPath, 'w') as brokenFile:
+                brokenFile.write('not a volume')
+
+            runner = batchThreshold.BatchThresholdRunner(os.path.join(directory, 'out'), maxWorkers=2)
+
+            # One job per input writes all thresholds; a worker that dies fails only its own job
+            dyingInput = None
+            thresholdJob = batchThreshold.thresholdJob
+            if hasattr(os, 'fork'):
+                # The patched function is only inherited by forked workers
+                dyingInput = os.path.join(directory, 'b.nrrd')
+                def dyingJob(job):
+                    if job['input'] == dyingInput:
+                        os._exit(9)
+                    return thresholdJob(job)
+                batchThreshold.thresholdJob = dyingJob
+            try:
+                records = runner.run(os.path.join(directory, '*.nrrd'), [0, 10.5])
+            finally:
+                batchThreshold.thresholdJob = thresholdJob
+
+            recordsByInput = dict((os.path.basename(record['input']), record) for record in records)
+            self.assertEqual(sorted(recordsByInput), ['a.nrrd', 'b.nrrd', 'broken.nrrd'])
+            self.assertEqual(sorted(runner.loadManifest(), key=lambda record: record['input']),
+                             sorted(records, key=lambda record: record['input']))
+            self.assertEqual(recordsByInput['a.nrrd']['status'], 'ok')
+            self.assertEqual(recordsByInput['a.nrrd']['thresholds'], [0.0, 10.5])
+            self.assertEqual(recordsByInput['broken.nrrd']['status'], 'failed')
+            if dyingInput is not None:
+                self.assertEqual(recordsByInput['b.nrrd']['status'], 'failed')
+                self.assertEqual(recordsByInput['b.nrrd']['error'], 'worker died (exit code 9)')
+
+            # Retrying reruns only the failed inputs
+            sitk.WriteImage(sitk.GetImageFromArray(voxels['a']), brokenPath)
+            records = runner.retryFailed()
+            retriedByInput = dict((os.path.basename(record['input']), record) for record in records)
+            self.assertEqual(retriedByInput['a.nrrd'], recordsByInput['a.nrrd'])
+            for name in ['b.nrrd', 'broken.nrrd']:
+                self.assertEqual(retriedByInput[name]['status'], 'ok')
+
+            for name, inputVoxels in [('a', voxels['a']), ('b', voxels['b']), ('broken', voxels['a'])]:
+                for threshold in [0, 10.5]:
+                    path = batchThreshold.outputPath(runner.outputDirectory, name + '.nrrd', threshold)
+                    outputVoxels = sitk.GetArrayFromImage(sitk.ReadImage(path))
+                    self.assertTrue(numpy.array_equal(outputVoxels, numpy.where(inputVoxels > threshold, 0, inputVoxels)))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_tipToModelDistance(self):
+
+        sphere = vtk.vtkSphereSource()
+        sphere.SetRadius(10.0)
+        sphere.SetThetaResolution(64)
+        sphere.SetPhiResolution(64)
+        sphere.Update()
+        modelNode = slicer.modules.models.logic().AddModel(sphere.GetOutput())
+
+        # The sphere is centered at the origin of the model and moved by its parent transform
+        center_Ras = numpy.array([20.0, -10.0, 5.0])
+        modelToRasMatrix = vtk.vtkMatrix4x4()
+        for i in range(3):
+            modelToRasMatrix.SetElement(i, 3, center_Ras[i])
+        modelToRas = slicer.vtkMRMLLinearTransformNode()
+        slicer.mrmlScene.AddNode(modelToRas)
+        modelToRas.SetMatrixTransformToParent(modelToRasMatrix)
+        modelNode.SetAndObserveTransformNodeID(modelToRas.GetID())
+
+        tipToModelDistance = TipToModelDistance()
+        tipToModelDistance.setModel(modelNode)
+        indexTime = tipToModelDistance._implicitDistance.GetMTime()
+
+        closestPoint_Ras, distance = tipToModelDistance.query(center_Ras + [0.0, 0.0, 4.0])
+        self.assertAlmostEqual(distance, -6.0, delta=0.1)
+        self.assertTrue(numpy.allclose(closestPoint_Ras, center_Ras + [0.0, 0.0, 10.0], atol=0.1))
+
+        closestPoint_Ras, distance = tipToModelDistance.query(center_Ras + [25.0, 0.0, 0.0])
+        self.assertAlmostEqual(distance, 15.0, delta=0.1)
+        self.assertTrue(numpy.allclose(closestPoint_Ras, center_Ras + [10.0, 0.0, 0.0], atol=0.1))
+
+        # The index was built by setModel and is reused by the queries
+        self.assertEqual(tipToModelDistance._implicitDistance.GetMTime(), indexTime)
+
+        emptyModelNode = slicer.modules.models.logic().AddModel(vtk.vtkPolyData())
+        tipToModelDistance.setModel(emptyModelNode)
+        closestPoint_Ras, distance = tipToModelDistance.query(center_Ras)
+        self.assertIsNone(closestPoint_Ras)
+        self.assertTrue(math.isnan(distance))
+
+    def test_trackerBus(self):
+
+        import time
+        import platform
+        from mareenaModuleLib import trackerBus
+
+        name = 'mareenaModuleTest-%d' % os.getpid()
+        if platform.machine().lower() not in trackerBus.X86_MACHINES:
+            self.assertRaises(RuntimeError, TrackerBusPublisher, name, ['A'], ['d'])
+            return
 
-        self.createChart(nVals, TREVals)
\ No newline at end of file
+        publisher = TrackerBusPublisher(name, ['A', 'B'], ['d'], capacity=8)
+        openedObjects = [publisher]
+        try:
+            reader = TrackerBusReader(name, timeout=1.0)
+            openedObjects.append(reader)
+            self.assertEqual(reader.toolNames, ['A', 'B'])
+            self.assertEqual(len(reader.poll()), 0)
+            self.assertEqual(reader.latest(), (-1, None))
+
+            # Round trip
+            poses = [numpy.eye(4), numpy.eye(4)]
+            for i in range(3):
+                poses[1][0, 3] = i
+                publisher.publish(poses, [i * 10.0], timestamp=100.0 + i)
+            frames = reader.poll()
+            self.assertEqual(list(frames['distances'][:, 0]), [0.0, 10.0, 20.0])
+            self.assertEqual(list(frames['timestamp']), [100.0, 101.0, 102.0])
+            self.assertEqual(list(frames['poses'][:, 1, 0, 3]), [0.0, 1.0, 2.0])
+            self.assertTrue(numpy.array_equal(frames['poses'][:, 0], numpy.tile(numpy.eye(4), (3, 1, 1))))
+
+            # latest() is a view that stays current until the publisher reuses its slot
+            frameNumber, frame = reader.latest()
+            self.assertEqual(frameNumber, 2)
+            self.assertEqual(frame['distances'][0], 20.0)
+            self.assertTrue(reader.isCurrent(frameNumber))
+            for i in range(3, 3 + publisher.capacity):
+                publisher.publish(poses, [i * 10.0])
+            self.assertFalse(reader.isCurrent(frameNumber))
+            frame = None
+
+            # A reader that falls more than capacity frames behind counts the lost frames
+            for i in range(3 + publisher.capacity, 15):
+                publisher.publish(poses, [i * 10.0])
+            frames = reader.poll()
+            self.assertEqual(reader.droppedFrames, 15 - 3 - publisher.capacity)
+            self.assertEqual(list(frames['distances'][:, 0]), [i * 10.0 for i in range(15 - publisher.capacity, 15)])
+
+            # A restarted publisher replaces the bus; closing the old one does not remove the new bus
+            restartedPublisher = TrackerBusPublisher(name, ['A'], ['d', 'e'], capacity=4)
+            openedObjects.append(restartedPublisher)
+            publisher.close()
+            openedObjects.remove(publisher)
+            self.assertTrue(os.path.exists(trackerBus.busPath(name)))
+            newReader = TrackerBusReader(name, timeout=1.0)
+            openedObjects.append(newReader)
+            self.assertEqual(newReader.generation, int(restartedPublisher._header['generation'][0]))
+
+            # The old reader reattaches to the new bus and reads it from its first frame
+            oldGeneration = reader.generation
+            restartedPublisher.publish([numpy.eye(4)], [1.0, 2.0])
+            time.sleep(trackerBus.RESTART_CHECK_INTERVAL * 1.5)
+            frames = reader.wait(timeout=1.0)
+            self.assertNotEqual(reader.generation, oldGeneration)
+            self.assertEqual(reader.distanceNames, ['d', 'e'])
+            self.assertEqual(list(frames['distances'][0]), [1.0, 2.0])
+        finally:
+            for openedObject in reversed(openedObjects):
+                openedObject.close()
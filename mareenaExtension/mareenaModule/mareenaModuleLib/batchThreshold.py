@@ -0,0 +1,313 @@
+"""Batch version of mareenaModuleLogic.run for directories of NRRD/NIfTI studies.
+
+This module does not import slicer so that it can be used from a plain Python
+interpreter with SimpleITK, and so that worker processes do not load the application.
+
+Example:
+    runner = BatchThresholdRunner('/data/out', maxWorkers=4, memoryLimit=8 * 1024 ** 3)
+    manifest = runner.run('/data/studies/*.nrrd', [100, 150])
+    manifest = runner.retryFailed()
+"""
+
+import os
+import glob
+import json
+import time
+import logging
+import traceback
+import multiprocessing
+
+try:
+    stringTypes = basestring
+except NameError:
+    stringTypes = str
+
+VOLUME_EXTENSIONS = ('.nrrd', '.nhdr', '.nii', '.nii.gz', '.mha', '.mhd')
+MANIFEST_NAME = 'manifest.json'
+
+
+def expandInputs(inputs):
+    """Returns the sorted list of volume files matching a glob pattern, a directory
+    or a list of either
+    """
+    if isinstance(inputs, stringTypes):
+        inputs = [inputs]
+    paths = []
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '*')
+        for path in glob.glob(pattern):
+            if path.lower().endswith(VOLUME_EXTENSIONS):
+                paths.append(os.path.abspath(path))
+    return sorted(set(paths))
+
+
+def outputPath(outputDirectory, inputPath, threshold):
+    name = os.path.basename(inputPath)
+    for extension in VOLUME_EXTENSIONS:
+        if name.lower().endswith(extension):
+            name = name[:-len(extension)]
+            break
+    return os.path.join(outputDirectory, '%s_threshold%g.nrrd' % (name, threshold))
+
+
+def estimateJobMemory(inputPath):
+    """Returns the bytes held by one job: the input volume and one thresholded copy
+    """
+    import SimpleITK as sitk
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(inputPath)
+    reader.ReadImageInformation()
+    numberOfVoxels = 1
+    for size in reader.GetSize():
+        numberOfVoxels = numberOfVoxels * size
+    bytesPerVoxel = sitk.Image(1, 1, reader.GetPixelID()).GetSizeOfPixelComponent() \
+        * reader.GetNumberOfComponents()
+    return 2 * numberOfVoxels * bytesPerVoxel
+
+
+def thresholdJob(job):
+    """Reads one volume and writes it thresholded with each of the job's thresholds,
+    so that every input is read from disk once. Runs in a worker process.
+    Voxels above the threshold are set to zero, as with the Threshold Scalar
+    Volume CLI and ThresholdType 'Above' used by mareenaModuleLogic.run.
+    Never raises; failures are reported in the returned record.
+    """
+    record = dict(job)
+    record['status'] = 'failed'
+    record['error'] = None
+    startTime = time.time()
+    try:
+        import SimpleITK as sitk
+
+        image = sitk.ReadImage(job['input'])
+        record['readSeconds'] = time.time() - startTime
+        record['computeSeconds'] = 0.0
+        record['writeSeconds'] = 0.0
+
+        for threshold, path in zip(job['thresholds'], job['outputs']):
+            computeTime = time.time()
+            output = sitk.Mask(image, image <= threshold, 0)
+            writeTime = time.time()
+
+            directory = os.path.dirname(path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            # Write to a temporary name so that an interrupted job never leaves a valid-looking output
+            temporaryPath = path + '.part.nrrd'
+            sitk.WriteImage(output, temporaryPath, True)
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(temporaryPath, path)
+
+            record['computeSeconds'] += writeTime - computeTime
+            record['writeSeconds'] += time.time() - writeTime
+        record['status'] = 'ok'
+    except Exception:
+        record['error'] = traceback.format_exc()
+    record['totalSeconds'] = time.time() - startTime
+    return record
+
+
+def thresholdJobProcess(job, connection):
+    """Process entry point: sends the job record back to the runner
+    """
+    connection.send(thresholdJob(job))
+    connection.close()
+
+
+class BatchThresholdRunner(object):
+    """Runs the thresholding of mareenaModuleLogic.run over many volumes in worker processes.
+
+    There is one job per input volume, which writes the output of every threshold.
+    Each job runs in its own process, so a worker that dies (out of memory, crash in ITK)
+    only fails its own job, which is recorded as failed and can be retried.
+    At most maxWorkers volumes are processed at once. If memoryLimit (bytes) is given,
+    jobs are only started while the estimated memory of the running jobs stays below it.
+    Since every worker reads, computes and writes its own volume, the read, compute and
+    write stages of different jobs overlap. The status and timings of every job are
+    kept in manifest.json in the output directory, which is used to retry failed jobs.
+    """
+
+    def __init__(self, outputDirectory, maxWorkers=None, memoryLimit=None):
+        self.outputDirectory = os.path.abspath(outputDirectory)
+        self.maxWorkers = maxWorkers or multiprocessing.cpu_count()
+        self.memoryLimit = memoryLimit
+        self.manifestPath = os.path.join(self.outputDirectory, MANIFEST_NAME)
+
+    def loadManifest(self):
+        if not os.path.exists(self.manifestPath):
+            return []
+        with open(self.manifestPath) as manifestFile:
+            return json.load(manifestFile)['jobs']
+
+    def saveManifest(self, records):
+        if not os.path.isdir(self.outputDirectory):
+            os.makedirs(self.outputDirectory)
+        temporaryPath = self.manifestPath + '.tmp'
+        with open(temporaryPath, 'w') as manifestFile:
+            json.dump({'jobs': records}, manifestFile, indent=2, sort_keys=True)
+        if os.path.exists(self.manifestPath):
+            os.remove(self.manifestPath)
+        os.rename(temporaryPath, self.manifestPath)
+
+    def run(self, inputs, thresholds, skipCompleted=True):
+        """Thresholds every input file with every threshold value.
+        inputs is a glob pattern, a directory or a list of them; thresholds is a value or a list.
+        Outputs that already succeeded according to the manifest are skipped unless skipCompleted is False.
+        Returns the list of manifest records, one per input.
+        """
+        if not isinstance(thresholds, (list, tuple)):
+            thresholds = [thresholds]
+        jobs = []
+        outputSources = {}
+        for inputPath in expandInputs(inputs):
+            job = {'input': inputPath, 'thresholds': [], 'outputs': []}
+            for threshold in thresholds:
+                path = outputPath(self.outputDirectory, inputPath, threshold)
+                if path in outputSources:
+                    otherInput, otherThreshold = outputSources[path]
+                    if otherInput == inputPath:
+                        logging.warning('Batch threshold: skipping threshold %r for %s, it has the same output name '
+                                        'as threshold %r (%s)' % (threshold, inputPath, otherThreshold, path))
+                    else:
+                        logging.warning('Batch threshold: skipping %s, it has the same file name as %s (%s)'
+                                        % (inputPath, otherInput, path))
+                    continue
+                outputSources[path] = (inputPath, threshold)
+                job['thresholds'].append(float(threshold))
+                job['outputs'].append(path)
+            if job['outputs']:
+                jobs.append(job)
+        return self._runJobs(jobs, skipCompleted)
+
+    def retryFailed(self):
+        """Runs again only the jobs recorded as failed in the manifest
+        """
+        jobs = [self._jobFromRecord(record) for record in self.loadManifest() if record['status'] != 'ok']
+        return self._runJobs(jobs, skipCompleted=False)
+
+    def _jobFromRecord(self, record):
+        return {'input': record['input'], 'thresholds': record['thresholds'], 'outputs': record['outputs']}
+
+    def _remainingJob(self, job, record):
+        """Returns the job without the outputs that the manifest record reports as written
+        """
+        if record is None or record['status'] != 'ok':
+            return job
+        done = set(path for path in record['outputs'] if os.path.exists(path))
+        remaining = [(threshold, path) for threshold, path in zip(job['thresholds'], job['outputs'])
+                     if path not in done]
+        return {'input': job['input'], 'thresholds': [threshold for threshold, path in remaining],
+                'outputs': [path for threshold, path in remaining]}
+
+    def _mergeRecord(self, previous, record):
+        """Keeps the outputs of a previous successful run of the same input in its new record
+        """
+        if previous is None or previous['status'] != 'ok' or record['status'] != 'ok':
+            return record
+        kept = [(threshold, path) for threshold, path in zip(previous['thresholds'], previous['outputs'])
+                if path not in record['outputs']]
+        record = dict(record)
+        record['thresholds'] = [threshold for threshold, path in kept] + record['thresholds']
+        record['outputs'] = [path for threshold, path in kept] + record['outputs']
+        return record
+
+    def _runJobs(self, jobs, skipCompleted):
+        recordsByInput = dict((record['input'], record) for record in self.loadManifest())
+        if skipCompleted:
+            jobs = [self._remainingJob(job, recordsByInput.get(job['input'])) for job in jobs]
+            jobs = [job for job in jobs if job['outputs']]
+        if not jobs:
+            return list(recordsByInput.values())
+
+        logging.info('Batch threshold: %d jobs on %d workers' % (len(jobs), self.maxWorkers))
+        pending = list(reversed(jobs))
+        running = {}
+        try:
+            while pending or running:
+                # Start as many jobs as the worker and memory budgets allow
+                while pending and len(running) < self.maxWorkers:
+                    job = pending[-1]
+                    jobMemory = self._jobMemory(job)
+                    runningMemory = sum(memory for (job, process, receiver, memory) in running.values())
+                    if running and self.memoryLimit is not None and runningMemory + jobMemory > self.memoryLimit:
+                        break
+                    pending.pop()
+                    receiver, sender = multiprocessing.Pipe(duplex=False)
+                    process = multiprocessing.Process(target=thresholdJobProcess, args=(job, sender))
+                    process.daemon = True
+                    process.start()
+                    sender.close()
+                    running[job['input']] = (job, process, receiver, jobMemory)
+
+                # Poll with a timeout instead of blocking, so dead workers and Ctrl-C are noticed
+                finishedJobs = []
+                for job, process, receiver, jobMemory in list(running.values()):
+                    # Sample liveness first: anything sent before exiting is readable afterwards
+                    alive = process.is_alive()
+                    if receiver.poll():
+                        try:
+                            record = receiver.recv()
+                        except (EOFError, IOError, OSError):
+                            record = None
+                    elif not alive:
+                        record = None
+                    else:
+                        continue
+                    process.join()
+                    receiver.close()
+                    if record is None:
+                        record = dict(job, status='failed', totalSeconds=None,
+                                      error='worker died (exit code %s)' % process.exitcode)
+                    finishedJobs.append(record)
+
+                if not finishedJobs:
+                    time.sleep(0.05)
+                    continue
+
+                for record in finishedJobs:
+                    del running[record['input']]
+                    recordsByInput[record['input']] = self._mergeRecord(recordsByInput.get(record['input']), record)
+                    if record['status'] != 'ok':
+                        logging.error('Batch threshold failed for %s:\n%s' % (record['input'], record['error']))
+                # Keep the manifest current so that an interrupted batch can be resumed
+                self.saveManifest(list(recordsByInput.values()))
+        finally:
+            for job, process, receiver, jobMemory in running.values():
+                process.terminate()
+                process.join()
+                receiver.close()
+
+        return list(recordsByInput.values())
+
+    def _jobMemory(self, job):
+        if self.memoryLimit is None:
+            return 0
+        try:
+            return estimateJobMemory(job['input'])
+        except Exception:
+            # Unreadable header: let the job run and report the error itself
+            return 0
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Threshold many volumes like the mareenaModule Apply button.')
+    parser.add_argument('inputs', nargs='*', help='input files, directories or glob patterns')
+    parser.add_argument('-o', '--output-directory', required=True)
+    parser.add_argument('-t', '--threshold', type=float, action='append', default=[])
+    parser.add_argument('-j', '--workers', type=int, default=None)
+    parser.add_argument('--memory-limit-mb', type=float, default=None)
+    parser.add_argument('--retry-failed', action='store_true', help='only rerun the jobs that failed in the manifest')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    memoryLimit = args.memory_limit_mb * 1024 * 1024 if args.memory_limit_mb is not None else None
+    runner = BatchThresholdRunner(args.output_directory, args.workers, memoryLimit)
+    if args.retry_failed:
+        records = runner.retryFailed()
+    else:
+        records = runner.run(args.inputs, args.threshold)
+    failed = [record for record in records if record['status'] != 'ok']
+    logging.info('%d inputs, %d failed. Manifest: %s' % (len(records), len(failed), runner.manifestPath))
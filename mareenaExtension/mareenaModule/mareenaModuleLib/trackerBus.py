@@ -0,0 +1,296 @@
+"""Shared memory ring buffer carrying tracked tool poses to other processes.
+
+The publisher (the mareenaModule widget) writes one frame per tracker update: a 4x4
+ToolToRas matrix per tool and a vector of derived distances. Readers in other processes
+map the same file and get numpy views of it, without any lock or message passing.
+
+There is a single writer. Each slot carries a sequence number that is odd while the
+slot is being written and even once it is complete (a seqlock), so readers can detect
+and drop torn or overwritten frames. This relies on stores becoming visible in program
+order, which holds on x86 but not on ARM, and Python offers no portable memory barrier,
+so the bus refuses to start on other architectures.
+
+A restarted publisher replaces the file and marks the old one as closed; readers notice
+this while idle and reattach to the new bus, starting from its first frame.
+
+This module does not import slicer, so readers only need numpy:
+
+    reader = TrackerBusReader('mareenaModule')
+    while True:
+        for frame in reader.wait(timeout=1.0):
+            print(frame['timestamp'], frame['distances'])
+"""
+
+import os
+import sys
+import platform
+import json
+import mmap
+import time
+import tempfile
+import numpy
+
+MAGIC = b'MTRKBUS1'
+HEADER_SIZE = 64
+NAMES_SIZE = 4096
+HEADER_DTYPE = numpy.dtype([('magic', 'S8'), ('numTools', '<u4'), ('numDistances', '<u4'),
+                            ('capacity', '<u4'), ('slotSize', '<u4'), ('lastFrame', '<i8'),
+                            ('generation', '<u8'), ('closed', '<u4')])
+X86_MACHINES = ('x86_64', 'amd64', 'i386', 'i686', 'x86')
+RESTART_CHECK_INTERVAL = 0.1
+
+
+def checkArchitecture():
+    if platform.machine().lower() not in X86_MACHINES:
+        raise RuntimeError('The tracker bus relies on x86 store ordering and is not supported on ' + platform.machine())
+
+
+def busPath(name):
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(directory, 'mareenaTrackerBus-' + name)
+
+
+def frameDtype(numTools, numDistances):
+    """Slot layout, padded to a multiple of 64 bytes so that slots do not share cache lines
+    """
+    packed = numpy.dtype([('sequence', '<u8'), ('timestamp', '<f8'),
+                          ('poses', '<f8', (numTools, 4, 4)), ('distances', '<f8', (numDistances,))])
+    return numpy.dtype({'names': packed.names,
+                        'formats': [packed.fields[name][0] for name in packed.names],
+                        'offsets': [packed.fields[name][1] for name in packed.names],
+                        'itemsize': (packed.itemsize + 63) // 64 * 64})
+
+
+class TrackerBusPublisher(object):
+    """Writes tool poses and distances to the shared ring buffer. Publishing a frame is
+    a couple of small numpy copies into the mapped memory, so it can be called from
+    the GUI thread for every tracker update.
+    """
+
+    def __init__(self, name, toolNames, distanceNames, capacity=1024):
+        self.name = name
+        self.path = busPath(name)
+        self.toolNames = list(toolNames)
+        self.distanceNames = list(distanceNames)
+        self.capacity = capacity
+        checkArchitecture()
+
+        dtype = frameDtype(len(self.toolNames), len(self.distanceNames))
+        size = HEADER_SIZE + NAMES_SIZE + capacity * dtype.itemsize
+        names = json.dumps({'tools': self.toolNames, 'distances': self.distanceNames}).encode('utf-8')
+        if len(names) > NAMES_SIZE:
+            raise ValueError('Tool and distance names do not fit in the tracker bus header')
+
+        # Replace rather than truncate an existing bus: readers still mapping the old file
+        # keep valid memory and see it marked as closed
+        if os.path.exists(self.path):
+            self._markClosed(self.path)
+            try:
+                os.remove(self.path)
+            except OSError as e:
+                # Windows does not remove files that another process has open or mapped
+                raise IOError('Cannot replace the tracker bus at %s, it is still open in another process: %s'
+                              % (self.path, e))
+        self._file = open(self.path, 'w+b')
+        self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+
+        self._header = numpy.frombuffer(self._map, dtype=HEADER_DTYPE, count=1, offset=0)
+        self._frames = numpy.frombuffer(self._map, dtype=dtype, count=capacity, offset=HEADER_SIZE + NAMES_SIZE)
+
+        self._map[HEADER_SIZE:HEADER_SIZE + len(names)] = names
+        self._header['numTools'] = len(self.toolNames)
+        self._header['numDistances'] = len(self.distanceNames)
+        self._header['capacity'] = capacity
+        self._header['slotSize'] = dtype.itemsize
+        self._header['lastFrame'] = -1
+        self._header['generation'] = numpy.frombuffer(os.urandom(8), dtype='<u8')[0]
+        self._header['closed'] = 0
+        self._frames['sequence'] = 0
+        # Written last: readers wait for the magic before trusting the rest of the header
+        self._header['magic'] = MAGIC
+
+        self.frameNumber = -1
+
+    def publish(self, poses, distances, timestamp=None):
+        """Writes one frame. poses is a sequence of 4x4 matrices (numpy arrays or vtkMatrix4x4),
+        one per tool, and distances a sequence of floats in the order of distanceNames
+        """
+        frameNumber = self.frameNumber + 1
+        frame = self._frames[frameNumber % self.capacity:frameNumber % self.capacity + 1]
+
+        frame['sequence'] = 2 * frameNumber + 1
+        frame['timestamp'] = time.time() if timestamp is None else timestamp
+        for i, pose in enumerate(poses):
+            if hasattr(pose, 'GetElement'):
+                pose = [[pose.GetElement(r, c) for c in range(4)] for r in range(4)]
+            frame['poses'][0, i] = pose
+        frame['distances'][0] = distances
+        frame['sequence'] = 2 * frameNumber + 2
+
+        self._header['lastFrame'] = frameNumber
+        self.frameNumber = frameNumber
+
+    def close(self, unlink=True):
+        """Marks the bus as closed and, if unlink is True, removes the file unless
+        a newer publisher has replaced it meanwhile
+        """
+        self._header['closed'] = 1
+        self._header = None
+        self._frames = None
+        inode = os.fstat(self._file.fileno()).st_ino
+        self._map.close()
+        self._file.close()
+        if not unlink:
+            return
+        try:
+            if os.stat(self.path).st_ino == inode:
+                os.remove(self.path)
+        except OSError:
+            # Already removed, or still open in a reader on Windows. Either way readers have
+            # seen the closed flag, and the next publisher replaces the file.
+            pass
+
+    def _markClosed(self, path):
+        """Flags a bus left by a previous publisher (e.g. one that crashed) as closed
+        """
+        try:
+            with open(path, 'r+b') as busFile:
+                header = busFile.read(HEADER_DTYPE.itemsize)
+                if len(header) == HEADER_DTYPE.itemsize and header[:len(MAGIC)] == MAGIC:
+                    busFile.seek(HEADER_DTYPE.fields['closed'][1])
+                    busFile.write(numpy.array([1], dtype='<u4').tobytes())
+        except (IOError, OSError):
+            pass
+
+
+class TrackerBusReader(object):
+    """Reads frames published by a TrackerBusPublisher with the same name.
+    poll() and wait() return the frames published since the previous call as a copied
+    structured array; latest() returns a zero-copy view of the newest frame.
+    If the reader falls more than capacity frames behind, the oldest frames are lost
+    and counted in droppedFrames. When the publisher restarts, poll() reattaches to the
+    new bus (toolNames, distanceNames and generation are updated) and returns its frames.
+    """
+
+    def __init__(self, name, timeout=10.0):
+        checkArchitecture()
+        self.path = busPath(name)
+        self.droppedFrames = 0
+        self._map = None
+        if not self._attach(timeout):
+            raise IOError('No tracker bus published at ' + self.path)
+        self.nextFrame = int(self._header['lastFrame'][0]) + 1
+
+    def _attach(self, timeout):
+        """Maps the current bus file. Returns False if none is published within timeout seconds.
+        """
+        deadline = time.time() + timeout
+        while True:
+            try:
+                busFile = open(self.path, 'rb')
+                busMap = mmap.mmap(busFile.fileno(), 0, access=mmap.ACCESS_READ)
+                header = numpy.frombuffer(busMap, dtype=HEADER_DTYPE, count=1, offset=0)
+                if header['magic'][0] == MAGIC and not header['closed'][0]:
+                    break
+                header = None
+                busMap.close()
+                busFile.close()
+            except (IOError, OSError, ValueError):
+                pass
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.01)
+
+        if self._map is not None:
+            self.close()
+        self._file = busFile
+        self._map = busMap
+        self._header = header
+        self._inode = os.fstat(busFile.fileno()).st_ino
+        self._lastRestartCheck = time.time()
+        self.generation = int(header['generation'][0])
+
+        names = json.loads(self._map[HEADER_SIZE:HEADER_SIZE + NAMES_SIZE].rstrip(b'\0').decode('utf-8'))
+        self.toolNames = names['tools']
+        self.distanceNames = names['distances']
+        self.capacity = int(self._header['capacity'][0])
+        dtype = frameDtype(len(self.toolNames), len(self.distanceNames))
+        self._frames = numpy.frombuffer(self._map, dtype=dtype, count=self.capacity, offset=HEADER_SIZE + NAMES_SIZE)
+        return True
+
+    def _publisherRestarted(self):
+        """True if the mapped bus was closed or the file was replaced by a new publisher
+        """
+        if self._header['closed'][0]:
+            return True
+        try:
+            return os.stat(self.path).st_ino != self._inode
+        except OSError:
+            return False
+
+    def latest(self):
+        """Returns (frameNumber, view) for the newest complete frame, or (-1, None).
+        The view aliases shared memory: check isCurrent(frameNumber) after using it
+        to make sure the publisher did not overwrite the slot meanwhile.
+        """
+        frameNumber = int(self._header['lastFrame'][0])
+        if frameNumber < 0:
+            return -1, None
+        return frameNumber, self._frames[frameNumber % self.capacity]
+
+    def isCurrent(self, frameNumber):
+        return int(self._frames['sequence'][frameNumber % self.capacity]) == 2 * frameNumber + 2
+
+    def poll(self):
+        """Returns a copy of the frames published since the last call (possibly empty)
+        """
+        lastFrame = int(self._header['lastFrame'][0])
+        if lastFrame < self.nextFrame:
+            # Only check for a restarted publisher while idle, and not on every poll
+            now = time.time()
+            if now - self._lastRestartCheck > RESTART_CHECK_INTERVAL:
+                self._lastRestartCheck = now
+                if self._publisherRestarted() and self._attach(0):
+                    self.nextFrame = 0
+                    return self.poll()
+            return self._frames[:0].copy()
+        if lastFrame - self.nextFrame + 1 > self.capacity:
+            self.droppedFrames += lastFrame - self.capacity + 1 - self.nextFrame
+            self.nextFrame = lastFrame - self.capacity + 1
+
+        slots = numpy.arange(self.nextFrame, lastFrame + 1) % self.capacity
+        frames = self._frames[slots]
+        # Keep only the frames that were complete and not overwritten while copying
+        expected = 2 * numpy.arange(self.nextFrame, lastFrame + 1) + 2
+        valid = (frames['sequence'] == expected) & (self._frames['sequence'][slots] == expected)
+        self.droppedFrames += int(numpy.count_nonzero(~valid))
+        self.nextFrame = lastFrame + 1
+        return frames[valid]
+
+    def wait(self, timeout=None, interval=0.0005):
+        """Blocks until at least one new frame is available or timeout seconds have passed
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            frames = self.poll()
+            if len(frames) or (deadline is not None and time.time() > deadline):
+                return frames
+            time.sleep(interval)
+
+    def close(self):
+        self._header = None
+        self._frames = None
+        try:
+            self._map.close()
+        except BufferError:
+            # Views returned by latest() are still alive; the mapping is released with them
+            pass
+        self._file.close()
+
+
+if __name__ == '__main__':
+    reader = TrackerBusReader(sys.argv[1] if len(sys.argv) > 1 else 'mareenaModule')
+    while True:
+        for frame in reader.wait(timeout=1.0):
+            print(' '.join('%s=%.3f' % (name, value) for name, value in zip(reader.distanceNames, frame['distances'])))
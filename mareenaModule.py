@@ -94,6 +94,14 @@ class mareenaModuleWidget(ScriptedLoadableModuleWidget):
     self.imageThresholdSliderWidget.setToolTip("Set threshold value for computing the output image. Voxels that have intensities lower than this value will set to zero.")
     parametersFormLayout.addRow("Image threshold", self.imageThresholdSliderWidget)
 
+    #
+    # check box to preview the threshold on the visible slices while dragging
+    #
+    self.livePreviewCheckBox = qt.QCheckBox()
+    self.livePreviewCheckBox.checked = 0
+    self.livePreviewCheckBox.setToolTip("If checked, moving the threshold slider thresholds only the voxels shown in the Red, Yellow and Green slices. The full volume is computed when the slider is released.")
+    parametersFormLayout.addRow("Live preview", self.livePreviewCheckBox)
+
     #
     # check box to trigger taking screen shots for later use in tutorials
     #
@@ -114,6 +122,16 @@ class mareenaModuleWidget(ScriptedLoadableModuleWidget):
     self.applyButton.connect('clicked(bool)', self.onApplyButton)
     self.inputSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
     self.outputSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
+    self.imageThresholdSliderWidget.connect("valueIsChanging(double)", self.onThresholdChanging)
+    self.imageThresholdSliderWidget.connect("valueChanged(double)", self.onThresholdReleased)
+    self.livePreviewCheckBox.connect("toggled(bool)", self.onLivePreviewToggled)
+
+    # Preview updates are coalesced to at most one per display frame
+    self.pendingPreviewThreshold = None
+    self.previewTimer = qt.QTimer()
+    self.previewTimer.setSingleShot(True)
+    self.previewTimer.setInterval(16)
+    self.previewTimer.connect('timeout()', self.onPreviewTimeout)
 
     # Add vertical spacer
     self.layout.addStretch(1)
@@ -122,10 +140,12 @@ class mareenaModuleWidget(ScriptedLoadableModuleWidget):
     self.onSelect()
 
   def cleanup(self):
-    pass
+    self.previewTimer.stop()
 
   def onSelect(self):
     self.applyButton.enabled = self.inputSelector.currentNode() and self.outputSelector.currentNode()
+    if self.livePreviewCheckBox.checked:
+      self.initializePreview()
 
   def onApplyButton(self):
     logic = mareenaModuleLogic()
@@ -133,6 +153,41 @@ class mareenaModuleWidget(ScriptedLoadableModuleWidget):
     imageThreshold = self.imageThresholdSliderWidget.value
     logic.run(self.inputSelector.currentNode(), self.outputSelector.currentNode(), imageThreshold, enableScreenshotsFlag)
 
+  def onLivePreviewToggled(self, checked):
+    # While previewing, valueChanged is only emitted when the slider is released
+    self.imageThresholdSliderWidget.tracking = not checked
+    if checked:
+      self.initializePreview()
+
+  def initializePreview(self):
+    # Allocating the preview output copies the whole volume, so it is done here and not while dragging
+    logic = mareenaModuleLogic()
+    logic.initializePreview(self.inputSelector.currentNode(), self.outputSelector.currentNode())
+
+  def onThresholdChanging(self, value):
+    if not self.livePreviewCheckBox.checked:
+      return
+    self.pendingPreviewThreshold = value
+    if not self.previewTimer.isActive():
+      self.previewTimer.start()
+
+  def onPreviewTimeout(self):
+    if self.pendingPreviewThreshold is None:
+      return
+    imageThreshold = self.pendingPreviewThreshold
+    self.pendingPreviewThreshold = None
+    logic = mareenaModuleLogic()
+    logic.previewThreshold(self.inputSelector.currentNode(), self.outputSelector.currentNode(), imageThreshold)
+
+  def onThresholdReleased(self, value):
+    if not self.livePreviewCheckBox.checked:
+      return
+    self.previewTimer.stop()
+    self.pendingPreviewThreshold = None
+    if not self.applyButton.enabled:
+      return
+    self.onApplyButton()
+
 #
 # mareenaModuleLogic
 #
@@ -234,6 +289,93 @@ class mareenaModuleLogic(ScriptedLoadableModuleLogic):
 
     return True
 
+  def initializePreview(self, inputVolume, outputVolume):
+    """Sets the output volume to a copy of the input, so that voxels outside the previewed
+    slices look unchanged. This copies the whole volume, so it is done once before
+    previewThreshold() is called and not while the slider moves.
+    """
+    if not self.isValidInputOutputData(inputVolume, outputVolume) or not self.hasImageData(inputVolume):
+      return False
+
+    outputImage = vtk.vtkImageData()
+    outputImage.DeepCopy(inputVolume.GetImageData())
+    outputVolume.SetAndObserveImageData(outputImage)
+    outputVolume.CopyOrientation(inputVolume)
+    slicer.util.setSliceViewerLayers(background=outputVolume)
+    return True
+
+  def previewThreshold(self, inputVolume, outputVolume, imageThreshold, sliceViewNames=("Red", "Yellow", "Green")):
+    """Applies the same threshold as run() but only to the voxels shown in the
+    given slice views, so the cost depends on the slice size and not on the volume size.
+    The rest of the output volume is left as it is until run() is called.
+    The output volume must have been prepared by initializePreview().
+    """
+    if not self.isValidInputOutputData(inputVolume, outputVolume) or not self.hasImageData(inputVolume):
+      return False
+
+    outputImage = outputVolume.GetImageData()
+    if outputImage is None or outputImage.GetDimensions() != inputVolume.GetImageData().GetDimensions():
+      logging.debug('previewThreshold failed: output volume not prepared by initializePreview')
+      return False
+
+    inputArray = slicer.util.arrayFromVolume(inputVolume)
+    outputArray = slicer.util.arrayFromVolume(outputVolume)
+
+    rasToIjk = vtk.vtkMatrix4x4()
+    inputVolume.GetRASToIJKMatrix(rasToIjk)
+    rasToIjk = numpy.array([[rasToIjk.GetElement(i, j) for j in range(4)] for i in range(4)])
+
+    layoutManager = slicer.app.layoutManager()
+    for sliceViewName in sliceViewNames:
+      sliceWidget = layoutManager.sliceWidget(sliceViewName)
+      if sliceWidget is None:
+        continue
+      index = self.sliceVoxelIndex(sliceWidget.mrmlSliceNode(), rasToIjk, inputArray.shape)
+      if index is None:
+        continue
+      voxels = inputArray[index]
+      outputArray[index] = numpy.where(voxels > imageThreshold, 0, voxels)
+
+    slicer.util.arrayFromVolumeModified(outputVolume)
+    return True
+
+  def sliceVoxelIndex(self, sliceNode, rasToIjk, shape):
+    """Returns a numpy index (in KJI order) selecting the voxels displayed in a slice view,
+    or None if the slice does not intersect the volume
+    """
+    xyToRas = vtk.vtkMatrix4x4()
+    xyToRas.DeepCopy(sliceNode.GetXYToRAS())
+    xyToRas = numpy.array([[xyToRas.GetElement(i, j) for j in range(4)] for i in range(4)])
+    xyToIjk = rasToIjk.dot(xyToRas)
+    dimensions = sliceNode.GetDimensions()
+
+    # The slice shows a single plane of voxels if the plane coordinate rounds to the same
+    # voxel index at the four corner pixels of the view
+    axis = numpy.argmax(numpy.abs(xyToIjk[:3, 2]))
+    corners = numpy.array([[0, 0, 0, 1], [dimensions[0] - 1, 0, 0, 1],
+                           [0, dimensions[1] - 1, 0, 1], [dimensions[0] - 1, dimensions[1] - 1, 0, 1]])
+    planes = numpy.rint(corners.dot(xyToIjk[axis]))
+    if numpy.all(planes == planes[0]):
+      plane = int(planes[0])
+      arrayAxis = 2 - axis
+      if plane < 0 or plane >= shape[arrayAxis]:
+        return None
+      index = [slice(None)] * 3
+      index[arrayAxis] = plane
+      return tuple(index)
+
+    # Oblique slice: look up the voxel under every displayed pixel, so the cost is
+    # bounded by the size of the view and not by the field of view or the voxel spacing
+    x = numpy.arange(dimensions[0])
+    y = numpy.arange(dimensions[1])[:, numpy.newaxis]
+    ijk = [numpy.rint(xyToIjk[c, 0] * x + xyToIjk[c, 1] * y + xyToIjk[c, 3]).astype(int).ravel() for c in range(3)]
+    inside = numpy.ones(ijk[0].size, dtype=bool)
+    for c in range(3):
+      inside &= (ijk[c] >= 0) & (ijk[c] < shape[2 - c])
+    if not numpy.any(inside):
+      return None
+    return (ijk[2][inside], ijk[1][inside], ijk[0][inside])
+
 
 class mareenaModuleTest(ScriptedLoadableModuleTest):
   """
@@ -252,6 +394,8 @@ class mareenaModuleTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_mareenaModule1()
+    self.setUp()
+    self.test_previewThreshold()
 
   def test_mareenaModule1(self):
 
@@ -321,3 +465,45 @@ class mareenaModuleTest(ScriptedLoadableModuleTest):
 
 	RasCoordinateModel.GetDisplayNode().SetColor(1,0,0)
 	ReferenceCoordinateModel.GetDisplayNode().SetColor(0,0,1)
+
+  def test_previewThreshold(self):
+
+    logic = mareenaModuleLogic()
+
+    voxels = numpy.random.normal(0.0, 50.0, (20, 30, 40)).astype(numpy.float32)
+    inputVolume = slicer.vtkMRMLScalarVolumeNode()
+    slicer.mrmlScene.AddNode(inputVolume)
+    inputVolume.SetSpacing(1.0, 1.0, 2.0)
+    slicer.util.updateVolumeFromArray(inputVolume, voxels)
+    outputVolume = slicer.vtkMRMLScalarVolumeNode()
+    slicer.mrmlScene.AddNode(outputVolume)
+
+    rasToIjk = vtk.vtkMatrix4x4()
+    inputVolume.GetRASToIJKMatrix(rasToIjk)
+    rasToIjk = numpy.array([[rasToIjk.GetElement(i, j) for j in range(4)] for i in range(4)])
+
+    # Single-plane slices select one voxel plane, or nothing outside the volume
+    sliceNode = slicer.vtkMRMLSliceNode()
+    sliceNode.SetDimensions(256, 256, 1)
+    sliceNode.SetFieldOfView(250.0, 250.0, 1.0)
+    everything = slice(None)
+    for setOrientation, offset, expected in ((sliceNode.SetOrientationToAxial, 10.0, (5, everything, everything)),
+                                             (sliceNode.SetOrientationToSagittal, 7.0, (everything, everything, 7)),
+                                             (sliceNode.SetOrientationToCoronal, 12.0, (everything, 12, everything))):
+      setOrientation()
+      sliceNode.SetSliceOffset(offset)
+      self.assertEqual(logic.sliceVoxelIndex(sliceNode, rasToIjk, voxels.shape), expected)
+      sliceNode.SetSliceOffset(-50.0)
+      self.assertIsNone(logic.sliceVoxelIndex(sliceNode, rasToIjk, voxels.shape))
+
+    # Only the voxels of the previewed plane are thresholded, as run() would
+    threshold = 20.0
+    self.assertFalse(logic.previewThreshold(inputVolume, outputVolume, threshold))
+    self.assertTrue(logic.initializePreview(inputVolume, outputVolume))
+    redNode = slicer.app.layoutManager().sliceWidget('Red').mrmlSliceNode()
+    redNode.SetOrientationToAxial()
+    redNode.SetSliceOffset(10.0)
+    self.assertTrue(logic.previewThreshold(inputVolume, outputVolume, threshold, sliceViewNames=('Red',)))
+    expected = voxels.copy()
+    expected[5] = numpy.where(voxels[5] > threshold, 0, voxels[5])
+    self.assertTrue(numpy.array_equal(slicer.util.arrayFromVolume(outputVolume), expected))